@@ -1,13 +1,27 @@
 import argparse
 import datetime
+import re
 import ufo2ft
 import ufoLib2
 
-from fontTools import subset
-from io import StringIO
+from collections import defaultdict
+from functools import lru_cache
+from itertools import chain
 from pcpp.preprocessor import Preprocessor
 from sfdLib.parser import SFDParser
 from sfdLib.utils import GLYPHCLASS_KEY, MATH_KEY
+from types import SimpleNamespace
+
+PREPROCESSOR_DIRECTIVE = re.compile(
+    r"^\s*#\s*(if|ifdef|ifndef|elif|else|endif|include|define|undef)\b",
+    re.MULTILINE)
+
+
+# Glyph part records are stored as "flags,start,end,advance" strings, and
+# there are only few distinct ones, so parse each of them only once.
+@lru_cache(maxsize=None)
+def parse_part_record(value):
+    return tuple(int(v) for v in value.split(","))
 
 
 class Font:
@@ -20,16 +34,22 @@ class Font:
         parser.parse()
 
         if features:
-            preprocessor = Preprocessor()
-            for d in ("italic", "sans", "display", "math"):
-                if d in filename.lower():
-                    preprocessor.define(d.upper())
             with open(features) as f:
-                preprocessor.parse(f)
-            feafile = StringIO()
-            preprocessor.write(feafile)
-            feafile.write(font.features.text)
-            font.features.text = feafile.getvalue()
+                text = f.read()
+            # Only run the preprocessor when the feature file needs it, plain
+            # feature files can be used as is.
+            if PREPROCESSOR_DIRECTIVE.search(text):
+                preprocessor = Preprocessor()
+                for d in ("italic", "sans", "display", "math"):
+                    if d in filename.lower():
+                        preprocessor.define(d.upper())
+                preprocessor.parse(text, features)
+                fea = []
+                preprocessor.write(SimpleNamespace(write=fea.append))
+                fea.append(font.features.text)
+                font.features.text = "".join(fea)
+            else:
+                font.features.text = text + font.features.text
 
     def _update_metadata(self):
         version = self._version
@@ -46,19 +66,19 @@ class Font:
     def _draw_over_under_line(self, name, widths):
         font = self._font
         bbox = font[name].getBounds(font)
-        pos = bbox[1]
-        height = bbox[-1] - bbox[1]
+        bottom, top = bbox[1], bbox[-1]
 
         for width in sorted(widths):
             glyph = font.newGlyph(f"{name}.{width}")
             glyph.width = 0
             glyph.lib[GLYPHCLASS_KEY] = "mark"
 
+            left = -25 - width
             pen = glyph.getPen()
-            pen.moveTo((-25 - width, pos))
-            pen.lineTo((-25 - width, pos + height))
-            pen.lineTo((25, pos + height))
-            pen.lineTo((25, pos))
+            pen.moveTo((left, bottom))
+            pen.lineTo((left, top))
+            pen.lineTo((25, top))
+            pen.lineTo((25, bottom))
             pen.closePath()
 
     def _make_over_under_line(self):
@@ -71,14 +91,11 @@ class Font:
 
         # Collect glyphs grouped by their widths rounded by minwidth, we will
         # use them to decide the widths of over/underline glyphs we will draw
-        widths = {}
+        widths = defaultdict(list)
         for glyph in font:
-            glyphclass = glyph.lib.get(GLYPHCLASS_KEY)
-            if glyphclass != 'mark' and glyph.width > 0:
-                width = round(glyph.width / minwidth) * minwidth
-                width = max(width, minwidth)
-                if width not in widths:
-                    widths[width] = []
+            width = glyph.width
+            if width > 0 and glyph.lib.get(GLYPHCLASS_KEY) != 'mark':
+                width = max(round(width / minwidth) * minwidth, minwidth)
                 widths[width].append(glyph.name)
 
         if len(widths) == 1:
@@ -87,9 +104,10 @@ class Font:
         for name in bases:
             self._draw_over_under_line(name, widths)
 
+        overset = " ".join(bases)
         fea = []
         fea.append("feature mark {")
-        fea.append(f"  @OverSet = [{' '.join(bases)}];")
+        fea.append(f"  @OverSet = [{overset}];")
         fea.append("  lookupflag UseMarkFilteringSet @OverSet;")
         for width in sorted(widths):
             # For each width group we create an over/underline glyph with the
@@ -97,26 +115,63 @@ class Font:
             # when an over/underline follows any glyph in this group
             replacements = ['%s.%d' % (name, width) for name in bases]
             fea.append("  sub [%s] [%s]' by [%s];" % (" ".join(widths[width]),
-                                                      " ".join(bases),
+                                                      overset,
                                                       " ".join(replacements)))
         fea.append("} mark;")
 
         self._font.features.text += "\n".join(fea)
 
     def _post_process(self, otf):
+        from fontTools.ttLib import newTable
+        from fontTools.ttLib.tables import otTables
+        from fontTools.otlLib import builder as otl
+
         font = self._font
         gdef = otf["GDEF"].table
         classdef = gdef.GlyphClassDef.classDefs
+
+        # Collect mark classes and glyph math data in a single pass over the
+        # font.
+        extended = set()
+        italic = {}
+        accent = {}
+        vvars = {}
+        hvars = {}
+        vcomp = {}
+        hcomp = {}
         for glyph in font:
-            if glyph.lib.get(GLYPHCLASS_KEY) == "mark":
-                classdef[glyph.name] = 3
+            name = glyph.name
+            lib = glyph.lib
+            if lib.get(GLYPHCLASS_KEY) == "mark":
+                classdef[name] = 3
+            math = lib.get(MATH_KEY)
+            if not math:
+                continue
+            if "IsExtendedShape" in math:
+                extended.add(name)
+            value = math.get("ItalicCorrection")
+            if value is not None:
+                italic[name] = otTables.MathValueRecord()
+                italic[name].Value = value
+            value = math.get("TopAccentHorizontal")
+            if value is not None:
+                accent[name] = otTables.MathValueRecord()
+                accent[name].Value = value
+            value = math.get("GlyphVariantsVertical")
+            if value is not None:
+                vvars[name] = value
+                value = math.get("GlyphCompositionVertical")
+                if value is not None:
+                    vcomp[name] = value
+            value = math.get("GlyphVariantsHorizontal")
+            if value is not None:
+                hvars[name] = value
+                value = math.get("GlyphCompositionHorizontal")
+                if value is not None:
+                    hcomp[name] = value
 
         constants = font.lib.get(MATH_KEY)
         if constants:
-            from fontTools.ttLib import newTable
-            from fontTools.ttLib.tables import otTables
-            from fontTools.otlLib import builder as otl
-
             glyphMap = {n: i for i, n in enumerate(font.glyphOrder)}
             table = otTables.MATH()
             table.Version = 0x00010000
@@ -134,32 +189,14 @@ class Font:
                     vr.Value = v
                     v = vr
                 setattr(table.MathConstants, c, v)
-            extended = set()
-            italic = {}
-            accent = {}
-            vvars = {}
-            hvars = {}
-            vcomp = {}
-            hcomp = {}
-            for glyph in font:
-                math = glyph.lib.get(MATH_KEY)
-                if math:
-                    if "IsExtendedShape" in math:
-                        extended.add(glyph.name)
-                    if "ItalicCorrection" in math:
-                        italic[glyph.name] = otTables.MathValueRecord()
-                        italic[glyph.name].Value = math["ItalicCorrection"]
-                    if "TopAccentHorizontal" in math:
-                        accent[glyph.name] = otTables.MathValueRecord()
-                        accent[glyph.name].Value = math["TopAccentHorizontal"]
-                    if "GlyphVariantsVertical" in math:
-                        vvars[glyph.name] = math["GlyphVariantsVertical"]
-                        if "GlyphCompositionVertical" in math:
-                            vcomp[glyph.name] = math["GlyphCompositionVertical"]
-                    if "GlyphVariantsHorizontal" in math:
-                        hvars[glyph.name] = math["GlyphVariantsHorizontal"]
-                        if "GlyphCompositionHorizontal" in math:
-                            hcomp[glyph.name] = math["GlyphCompositionHorizontal"]
+
+            # Variant glyphs are often shared between constructions, so
+            # compute the bounds of each of them only once, up front.
+            bounds = {}
+            for variants in chain(vvars.values(), hvars.values()):
+                for variant in variants:
+                    if variant not in bounds:
+                        bounds[variant] = font[variant].getBounds(font)
 
             table.MathGlyphInfo = otTables.MathGlyphInfo()
             table.MathGlyphInfo.populateDefaults()
@@ -179,30 +216,33 @@ class Font:
             table.MathVariants = otTables.MathVariants()
             table.MathVariants.MinConnectorOverlap = constants["MinConnectorOverlap"]
 
-            coverage = otl.buildCoverage(vvars.keys(), glyphMap)
+            # Sort the glyphs by their glyph ID once, which is the order of
+            # both the coverage and the constructions.
+            vvars = sorted(vvars.items(), key=lambda item: glyphMap[item[0]])
+            coverage = otl.buildCoverage([name for name, _ in vvars], glyphMap)
             table.MathVariants.VertGlyphCoverage = coverage
             table.MathVariants.VertGlyphConstruction = []
-            for name in coverage.glyphs:
-                variants = vvars[name]
+            for name, variants in vvars:
                 construction = otTables.MathGlyphConstruction()
                 construction.populateDefaults()
                 construction.VariantCount = len(variants)
                 construction.MathGlyphVariantRecord = []
                 for variant in variants:
-                    bbox = font[variant].getBounds(font)
+                    bbox = bounds[variant]
                     record = otTables.MathGlyphVariantRecord()
                     record.VariantGlyph = variant
                     record.AdvanceMeasurement = int(bbox[-1] - bbox[1] + 1)
                     construction.MathGlyphVariantRecord.append(record)
-                if name in vcomp:
+                parts = vcomp.get(name)
+                if parts is not None:
                     construction.GlyphAssembly = otTables.GlyphAssembly()
                     construction.GlyphAssembly.ItalicsCorrection = otTables.MathValueRecord()
                     construction.GlyphAssembly.ItalicsCorrection.Value = 0
                     construction.GlyphAssembly.PartRecords = []
-                    for comp in vcomp[name]:
+                    for comp in parts:
                         record = otTables.GlyphPartRecord()
                         record.glyph = comp[0]
-                        f, s, e, a = [int(v) for v in comp[1].split(",")]
+                        f, s, e, a = parse_part_record(comp[1])
                         record.StartConnectorLength = s
                         record.EndConnectorLength = e
                         record.FullAdvance = a
@@ -210,30 +250,31 @@ class Font:
                         construction.GlyphAssembly.PartRecords.append(record)
                 table.MathVariants.VertGlyphConstruction.append(construction)
 
-            coverage = otl.buildCoverage(hvars.keys(), glyphMap)
+            hvars = sorted(hvars.items(), key=lambda item: glyphMap[item[0]])
+            coverage = otl.buildCoverage([name for name, _ in hvars], glyphMap)
             table.MathVariants.HorizGlyphCoverage = coverage
             table.MathVariants.HorizGlyphConstruction = []
-            for name in coverage.glyphs:
-                variants = hvars[name]
+            for name, variants in hvars:
                 construction = otTables.MathGlyphConstruction()
                 construction.populateDefaults()
                 construction.VariantCount = len(variants)
                 construction.MathGlyphVariantRecord = []
                 for variant in variants:
-                    bbox = font[variant].getBounds(font)
+                    bbox = bounds[variant]
                     record = otTables.MathGlyphVariantRecord()
                     record.VariantGlyph = variant
                     record.AdvanceMeasurement = int(bbox[-2] - bbox[0] + 1)
                     construction.MathGlyphVariantRecord.append(record)
-                if name in hcomp:
+                parts = hcomp.get(name)
+                if parts is not None:
                     construction.GlyphAssembly = otTables.GlyphAssembly()
                     construction.GlyphAssembly.ItalicsCorrection = otTables.MathValueRecord()
                     construction.GlyphAssembly.ItalicsCorrection.Value = 0
                     construction.GlyphAssembly.PartRecords = []
-                    for comp in hcomp[name]:
+                    for comp in parts:
                         record = otTables.GlyphPartRecord()
                         record.glyph = comp[0]
-                        f, s, e, a = [int(v) for v in comp[1].split(",")]
+                        f, s, e, a = parse_part_record(comp[1])
                         record.StartConnectorLength = s
                         record.EndConnectorLength = e
                         record.FullAdvance = a
@@ -246,6 +287,8 @@ class Font:
             otf["MATH"].table = table
 
     def _prune(self, otf):
+        from fontTools import subset
+
         options = subset.Options()
         options.set(layout_features='*', name_IDs='*', notdef_outline=True,
             recalc_average_width=True, recalc_bounds=True)